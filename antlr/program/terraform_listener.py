@@ -0,0 +1,50 @@
+from TerraformSubsetListener import TerraformSubsetListener
+
+def _unq(tok):
+    """Text of a token or context without its surrounding double quotes"""
+    s = tok.getText()
+    return s[1:-1] if s.startswith('"') else s
+
+# Bump CACHE_VERSION in terraform_parser.py when changing what this listener extracts
+class TerraformApplyListener(TerraformSubsetListener):
+    def __init__(self):
+        self.variables = {}
+        self.provider_token_expr = None  # store raw expression (e.g., var.token)
+        self.droplet_config = {}
+        self.droplet_id = None
+        self.droplet_ip = None
+
+    def enterVariable(self, ctx):
+        var_name = _unq(ctx.STRING())
+        body = ctx.body()
+        # Only the default matters, so stop scanning once it is found
+        for kv in body.keyValue():
+            if kv.IDENTIFIER().getText() == "default":
+                value = _unq(kv.expr())
+                self.variables[var_name] = value
+                #print(f"[var] {var_name} = {value}")
+                break
+
+    def enterProvider(self, ctx):
+        provider_name = _unq(ctx.STRING())
+        if provider_name != "digitalocean":
+            raise Exception("Only 'digitalocean' provider is supported.")
+
+        body = ctx.body()
+        for kv in body.keyValue():
+            if kv.IDENTIFIER().getText() == "token":
+                self.provider_token_expr = kv.expr().getText()  # store raw expr for now
+                break
+
+    def enterResource(self, ctx):
+        type_ = _unq(ctx.STRING(0))
+        name = _unq(ctx.STRING(1))
+        if type_ != "digitalocean_droplet":
+            return
+
+        body = ctx.body()
+        droplet_config = self.droplet_config
+        for kv in body.keyValue():
+            id_tok = kv.IDENTIFIER()
+            expr_ctx = kv.expr()
+            droplet_config[id_tok.getText()] = _unq(expr_ctx)
@@ -4,50 +4,49 @@ import json
 import os
 import subprocess
 import argparse
-import requests
-from antlr4 import *
-from TerraformSubsetLexer import TerraformSubsetLexer
-from TerraformSubsetParser import TerraformSubsetParser
-from TerraformSubsetListener import TerraformSubsetListener
-
-class TerraformApplyListener(TerraformSubsetListener):
-    def __init__(self):
-        self.variables = {}
-        self.provider_token_expr = None  # store raw expression (e.g., var.token)
-        self.droplet_config = {}
+import hashlib
+import socket
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# Droplet status polling (seconds)
+POLL_INITIAL_DELAY = 1.0
+POLL_MAX_DELAY = 16.0
+
+# Max seconds for a single DigitalOcean API request
+API_TIMEOUT = 30
+
+# Max seconds for each terraform subprocess
+TERRAFORM_TIMEOUT = 120
+
+# Shared provider cache for terraform init (unless TF_PLUGIN_CACHE_DIR is already set)
+PLUGIN_CACHE_DIR = os.path.expanduser("~/.terraform.d/plugin-cache")
+
+# Parsed .tf files are cached here when --cache / TF_PARSER_CACHE=1 is set
+CACHE_DIR = os.path.expanduser("~/.cache/terraform_parser")
+# Bump whenever TerraformApplyListener changes what it extracts, so stale entries are reparsed
+CACHE_VERSION = 1
+
+DO_API_URL = "https://api.digitalocean.com/v2"
+
+# Shared HTTP session, created by _session() on the first API call
+_SESSION = None
+
+class ParsedTerraform:
+    """Values extracted from a Terraform file, either by the listener or from the parse cache"""
+    def __init__(self, variables, provider_token_expr, droplet_config):
+        self.variables = variables
+        self.provider_token_expr = provider_token_expr
+        self.droplet_config = droplet_config
         self.droplet_id = None
         self.droplet_ip = None
 
-    def enterVariable(self, ctx):
-        var_name = ctx.STRING().getText().strip('"')
-        for kv in ctx.body().keyValue():
-            key = kv.IDENTIFIER().getText()
-            if key == "default":
-                value = kv.expr().getText().strip('"')
-                self.variables[var_name] = value
-                #print(f"[var] {var_name} = {value}")
-
-    def enterProvider(self, ctx):
-        provider_name = ctx.STRING().getText().strip('"')
-        if provider_name != "digitalocean":
-            raise Exception("Only 'digitalocean' provider is supported.")
-
-        for kv in ctx.body().keyValue():
-            key = kv.IDENTIFIER().getText()
-            expr = kv.expr().getText()
-            if key == "token":
-                self.provider_token_expr = expr  # store raw expr for now
-
-    def enterResource(self, ctx):
-        type_ = ctx.STRING(0).getText().strip('"')
-        name = ctx.STRING(1).getText().strip('"')
-        if type_ != "digitalocean_droplet":
-            return
-
-        for kv in ctx.body().keyValue():
-            key = kv.IDENTIFIER().getText()
-            val = kv.expr().getText().strip('"')
-            self.droplet_config[key] = val
+    def to_dict(self):
+        return {
+            "variables": self.variables,
+            "provider_token_expr": self.provider_token_expr,
+            "droplet_config": self.droplet_config,
+        }
 
     def resolve_token(self):
         if not self.provider_token_expr:
@@ -61,14 +60,127 @@ class TerraformApplyListener(TerraformSubsetListener):
         return self.provider_token_expr.strip('"')
 
 
+def _session(api_token):
+    """Shared HTTP session, so the create, poll and delete calls reuse one TLS connection"""
+    global _SESSION
+    if _SESSION is None:
+        # Imported here so runs that never reach the API don't pay for it
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.connection import HTTPConnection
+        from urllib3.util.retry import Retry
+
+        class KeepAliveAdapter(HTTPAdapter):
+            """Adapter that adds SO_KEEPALIVE to urllib3's default socket options (TCP_NODELAY)"""
+            def init_poolmanager(self, *args, **kwargs):
+                kwargs["socket_options"] = HTTPConnection.default_socket_options + [
+                    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+                ]
+                super().init_poolmanager(*args, **kwargs)
 
-def create_droplet(api_token, config):
-    """Create a DigitalOcean droplet"""
-    url = "https://api.digitalocean.com/v2/droplets"
-    headers = {
+        # Retry only covers idempotent methods, so a failed POST never creates a second droplet
+        _SESSION = requests.Session()
+        _SESSION.mount("https://", KeepAliveAdapter(
+            pool_connections=4,
+            pool_maxsize=8,
+            max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504]),
+        ))
+    _SESSION.headers.update({
         "Content-Type": "application/json",
         "Authorization": f"Bearer {api_token}"
-    }
+    })
+    return _SESSION
+
+def _parse_terraform(path):
+    """Run the ANTLR lexer, parser and listener over a Terraform file"""
+    # ANTLR is only loaded when a file actually has to be parsed (not on parse cache hits)
+    from antlr4 import FileStream, CommonTokenStream, ParseTreeWalker
+    from TerraformSubsetLexer import TerraformSubsetLexer
+    from TerraformSubsetParser import TerraformSubsetParser
+    from terraform_listener import TerraformApplyListener
+
+    input_stream = FileStream(path)
+    lexer = TerraformSubsetLexer(input_stream)
+    stream = CommonTokenStream(lexer)
+    terraform_parser = TerraformSubsetParser(stream)
+    tree = terraform_parser.terraform()
+
+    listener = TerraformApplyListener()
+    walker = ParseTreeWalker()
+    walker.walk(listener, tree)
+    return ParsedTerraform(listener.variables, listener.provider_token_expr, listener.droplet_config)
+
+def _load_or_parse(path, use_cache=False):
+    """Return the parsed Terraform file, reusing a cached result while the file is unchanged"""
+    if not use_cache:
+        return _parse_terraform(path)
+
+    path = os.path.abspath(path)
+    with open(path, 'rb') as f:
+        digest = hashlib.blake2b(f.read(), digest_size=16)
+    digest.update(str(os.path.getmtime(path)).encode())
+    digest.update(str(CACHE_VERSION).encode())
+    digest = digest.hexdigest()
+    # Entries hold the resolved API token: keep a single 0600 entry per .tf path that is
+    # overwritten on change instead of piling up old copies
+    path_key = hashlib.blake2b(path.encode(), digest_size=16).hexdigest()
+    cache_file = os.path.join(CACHE_DIR, f"{path_key}.json")
+
+    try:
+        with open(cache_file, 'r') as f:
+            entry = json.load(f)
+        if entry["digest"] == digest:
+            return ParsedTerraform(**entry["parsed"])
+    except (OSError, ValueError, TypeError, KeyError):
+        pass
+
+    parsed = _parse_terraform(path)
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        os.chmod(CACHE_DIR, 0o700)
+        _write_json({"digest": digest, "parsed": parsed.to_dict()}, cache_file)
+    except OSError as e:
+        print(f"[!] Failed to write parse cache: {e}")
+    return parsed
+
+
+
+def _poll(session, url, deadline, extract):
+    """GET url with exponential backoff until extract(response_json) returns a value"""
+    import requests
+
+    # The poll request never changes, so build its URL and headers once and resend it
+    request = session.prepare_request(requests.Request("GET", url))
+    send_kwargs = session.merge_environment_settings(url, {}, None, None, None)
+    delay = POLL_INITIAL_DELAY
+    while True:
+        resp = session.send(request, timeout=API_TIMEOUT, **send_kwargs)
+        resp.raise_for_status()
+        result = extract(resp.json())
+        if result:
+            return result
+
+        # Exponential backoff: 1s, 2s, 4s, 8s, then capped
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"Gave up waiting on {url}")
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, POLL_MAX_DELAY)
+
+def _action_completed(data):
+    action = data["action"]
+    if action["status"] == "errored":
+        raise Exception(f"Droplet action {action['id']} errored (run --action destroy to remove the droplet)")
+    return action["status"] == "completed"
+
+def _public_ip(data):
+    networks = data["droplet"].get("networks", {}).get("v4", ())
+    return next((n["ip_address"] for n in networks if n["type"] == "public"), None)
+
+def create_droplet(api_token, config, max_wait=300, on_created=None):
+    """Create a DigitalOcean droplet and wait up to max_wait seconds for its public IP"""
+    url = f"{DO_API_URL}/droplets"
+    session = _session(api_token)
 
     payload = {
         "name": config["name"],
@@ -85,31 +197,34 @@ def create_droplet(api_token, config):
     }
 
     print("[*] Creating droplet...")
-    response = requests.post(url, headers=headers, json=payload)
+    response = session.post(url, json=payload, timeout=API_TIMEOUT)
     response.raise_for_status()
-    droplet = response.json()["droplet"]
-    droplet_id = droplet["id"]
+    created = response.json()
+    droplet_id = created["droplet"]["id"]
     print(f"[+] Droplet created with ID: {droplet_id}")
+    # Let the caller record the droplet before any waiting, so a failed wait doesn't leak it
+    if on_created is not None:
+        on_created(droplet_id)
 
-    print("[*] Waiting for droplet to become active and assigned an IP...")
-    while True:
-        resp = requests.get(f"https://api.digitalocean.com/v2/droplets/{droplet_id}", headers=headers)
-        droplet_info = resp.json()["droplet"]
-        networks = droplet_info["networks"]["v4"]
-        public_ips = [n["ip_address"] for n in networks if n["type"] == "public"]
-        if public_ips:
-            return droplet_id, public_ips[0]
-        time.sleep(5)
+    deadline = time.monotonic() + max_wait
+    # The create action is small to poll and completes once the droplet is active,
+    # after which the IP is normally there on the first droplet GET
+    actions = created.get("links", {}).get("actions", [])
+    if actions:
+        print("[*] Waiting for droplet to become active...")
+        _poll(session, actions[0]["href"], deadline, _action_completed)
+
+    print("[*] Waiting for droplet to be assigned an IP...")
+    ip = _poll(session, f"{DO_API_URL}/droplets/{droplet_id}", deadline, _public_ip)
+    return droplet_id, ip
 
 def delete_droplet_api(api_token, droplet_id):
     """Delete droplet using REST API"""
-    url = f"https://api.digitalocean.com/v2/droplets/{droplet_id}"
-    headers = {
-        "Authorization": f"Bearer {api_token}"
-    }
+    url = f"{DO_API_URL}/droplets/{droplet_id}"
+    session = _session(api_token)
     
     print(f"[*] Deleting droplet {droplet_id} via REST API...")
-    response = requests.delete(url, headers=headers)
+    response = session.delete(url, timeout=API_TIMEOUT)
     
     if response.status_code == 204:
         print(f"[✓] Droplet {droplet_id} deleted successfully")
@@ -120,7 +235,40 @@ def delete_droplet_api(api_token, droplet_id):
 
 
 
-def save_statefile(droplet_info, filename="terraform.tfstate"):
+def _write_json(data, filename, human=False):
+    """Atomically write data as JSON, returning False if the file already held this exact content"""
+    if human:
+        content = json.dumps(data, indent=2).encode()
+    else:
+        content = json.dumps(data, separators=(',', ':')).encode()
+
+    # A size mismatch settles it without reading the old file
+    try:
+        if os.path.getsize(filename) == len(content):
+            with open(filename, 'rb') as f:
+                if f.read() == content:
+                    return False
+    except FileNotFoundError:
+        pass
+
+    # fsync a temp file in the same directory, then os.replace: an interrupted run leaves
+    # either the old file or the new one, never a partial write
+    with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(filename) or ".",
+                                     prefix=os.path.basename(filename), suffix=".tmp",
+                                     delete=False) as f:
+        tmp_name = f.name
+        try:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            f.close()
+            os.remove(tmp_name)
+            raise
+    os.replace(tmp_name, filename)
+    return True
+
+def save_statefile(droplet_info, filename="terraform.tfstate", human=False):
     """Create and save a terraform statefile"""
     statefile_content = {
         "version": 4,
@@ -155,114 +303,184 @@ def save_statefile(droplet_info, filename="terraform.tfstate"):
     }
     
     try:
-        with open(filename, 'w') as f:
-            json.dump(statefile_content, f, indent=2)
-        print(f"[✓] Terraform statefile saved: {filename}")
+        if _write_json(statefile_content, filename, human):
+            print(f"[✓] Terraform statefile saved: {filename}")
+        else:
+            print(f"[✓] Terraform statefile unchanged: {filename}")
         return True
     except Exception as e:
         print(f"[!] Failed to save statefile: {e}")
         return False
 
-def save_droplet_info_json(droplet_info, filename="droplet_info.json"):
+def save_droplet_info_json(droplet_info, filename="droplet_info.json", human=False):
     """Save droplet information to JSON file"""
     try:
-        with open(filename, 'w') as f:
-            json.dump(droplet_info, f, indent=2)
-        print(f"[✓] Droplet info saved to: {filename}")
+        if _write_json(droplet_info, filename, human):
+            print(f"[✓] Droplet info saved to: {filename}")
+        else:
+            print(f"[✓] Droplet info unchanged: {filename}")
         return True
     except Exception as e:
         print(f"[!] Failed to save droplet info: {e}")
         return False
 
-def run_terraform_commands():
-    """Run standard terraform commands"""
-    commands = [
-        ["terraform", "init"],
-        ["terraform", "plan"],
+def _read_droplet_id():
+    """Droplet ID recorded by a previous apply, or None if there is none"""
+    sources = [
+        ("droplet_info.json", "id", lambda data: data["id"]),
+        ("terraform.tfstate", "resources.item.instances.item.attributes.id",
+         lambda data: data["resources"][0]["instances"][0]["attributes"]["id"]),
     ]
-    
-    for cmd in commands:
-        try:
-            print(f"[*] Running: {' '.join(cmd)}")
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
-            
-            if result.returncode == 0:
-                print(f"[✓] {cmd[1]} completed successfully")
-                if result.stdout:
-                    print(result.stdout)
+    # Only the id is needed: stream it with ijson when installed, otherwise decode with json
+    try:
+        import ijson
+    except ImportError:
+        ijson = None
+
+    for filename, prefix, pick in sources:
+        if not os.path.exists(filename):
+            continue
+        with open(filename, 'rb') as f:
+            if ijson is not None:
+                droplet_id = next(ijson.items(f, prefix), None)
             else:
-                print(f"[!] {cmd[1]} failed:")
-                print(result.stderr)
-                return False
-        except Exception as e:
-            print(f"[!] Error running {' '.join(cmd)}: {e}")
-            return False
-    
-    return True
+                try:
+                    droplet_id = pick(json.load(f))
+                except (KeyError, IndexError, TypeError):
+                    droplet_id = None
+        if droplet_id is not None:
+            return droplet_id
+    return None
+
+def _run_command(cmd, timeout=TERRAFORM_TIMEOUT, env=None):
+    """Run a command and return its exit code"""
+    # The child inherits our stdout/stderr, so its output never passes through Python
+    proc = subprocess.Popen(cmd, env=env)
+    try:
+        return proc.wait(timeout=timeout)
+    finally:
+        # Covers the timeout as well as Ctrl-C or any other interruption of the wait
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+def _run_terraform(cmd, env=None):
+    """Run one terraform command, returning True on success"""
+    try:
+        print(f"[*] Running: {' '.join(cmd)}")
+        returncode = _run_command(cmd, env=env)
+        
+        if returncode == 0:
+            print(f"[✓] {cmd[1]} completed successfully")
+            return True
+        print(f"[!] {cmd[1]} failed (exit code {returncode})")
+        return False
+    except Exception as e:
+        print(f"[!] Error running {' '.join(cmd)}: {e}")
+        return False
+
+def terraform_init(upgrade=False, skip=False):
+    """Run terraform init unless the providers are already installed and locked"""
+    if skip:
+        return True
+    if not upgrade and os.path.isdir(".terraform/providers") and os.path.isfile(".terraform.lock.hcl"):
+        print("[✓] init skipped, providers already installed")
+        return True
+
+    # A shared plugin cache lets a cold working directory reuse providers other projects fetched
+    env = dict(os.environ)
+    plugin_cache = env.setdefault("TF_PLUGIN_CACHE_DIR", PLUGIN_CACHE_DIR)
+    try:
+        os.makedirs(plugin_cache, exist_ok=True)
+    except OSError as e:
+        # e.g. an unwritable $HOME; init still works, just without the shared cache
+        print(f"[!] Plugin cache unavailable, running init without it: {e}")
+        del env["TF_PLUGIN_CACHE_DIR"]
+    cmd = ["terraform", "init"]
+    if upgrade:
+        cmd.append("-upgrade")
+    return _run_terraform(cmd, env)
+
+def run_terraform_commands(init_ok=None):
+    """Run standard terraform commands"""
+    # init_ok is the result of a terraform_init() that already ran
+    if init_ok is None:
+        init_ok = terraform_init()
+    if not init_ok:
+        return False
+    return _run_terraform(["terraform", "plan"])
 
 def main():
     parser = argparse.ArgumentParser(description='Enhanced Terraform Parser with full lifecycle management')
     parser.add_argument('terraform_file', help='Path to the Terraform file')
     parser.add_argument('--action', choices=['apply', 'destroy', 'plan'], default='apply',
                        help='Action to perform (default: apply)')
+    parser.add_argument('--wait-timeout', type=int, default=300,
+                       help='Max seconds to wait for the droplet IP (default: 300)')
+    parser.add_argument('--cache', action='store_true',
+                       default=os.environ.get('TF_PARSER_CACHE') == '1',
+                       help='Reuse the parsed Terraform file while it is unchanged (or set TF_PARSER_CACHE=1)')
+    parser.add_argument('--human', action='store_true',
+                       help='Pretty-print the generated JSON files')
+    parser.add_argument('--no-init', action='store_true',
+                       help='Never run terraform init (providers are already installed)')
+    parser.add_argument('--upgrade', action='store_true',
+                       help='Always run terraform init -upgrade')
 
     
     args = parser.parse_args()
 
     try:
         # Parse Terraform file
-        input_stream = FileStream(args.terraform_file)
-        lexer = TerraformSubsetLexer(input_stream)
-        stream = CommonTokenStream(lexer)
-        terraform_parser = TerraformSubsetParser(stream)
-        tree = terraform_parser.terraform()
-
-        listener = TerraformApplyListener()
-        walker = ParseTreeWalker()
-        walker.walk(listener, tree)
-
-        token = listener.resolve_token()
-        if not listener.droplet_config:
+        terraform = _load_or_parse(args.terraform_file, args.cache)
+
+        token = terraform.resolve_token()
+        if not terraform.droplet_config:
             raise Exception("Missing digitalocean_droplet resource.")
 
         if args.action == 'apply':
-            # Create droplet
-            droplet_id, ip = create_droplet(token, listener.droplet_config)
-            listener.droplet_id = droplet_id
-            listener.droplet_ip = ip
-            
-            print(f"[✓] Droplet available at IP: {ip}")
-            print(f"[✓] Droplet ID: {droplet_id}")
-
-            # Save droplet information
             droplet_info = {
-                "id": droplet_id,
-                "ip": ip,
-                "name": listener.droplet_config["name"],
-                "region": listener.droplet_config["region"],
-                "size": listener.droplet_config["size"],
-                "image": listener.droplet_config["image"],
+                "id": None,
+                "ip": None,
+                "name": terraform.droplet_config["name"],
+                "region": terraform.droplet_config["region"],
+                "size": terraform.droplet_config["size"],
+                "image": terraform.droplet_config["image"],
                 "created_at": time.strftime('%Y-%m-%dT%H:%M:%SZ'),
                 "tags": []
             }
+
+            def record_created(droplet_id):
+                # Persist the id right away so --action destroy can clean up
+                # even if waiting for the IP times out or fails
+                droplet_info["id"] = droplet_id
+                save_droplet_info_json(droplet_info, human=args.human)
+
+            # Create droplet
+            droplet_id, ip = create_droplet(token, terraform.droplet_config, args.wait_timeout,
+                                            on_created=record_created)
+            terraform.droplet_id = droplet_id
+            terraform.droplet_ip = ip
+            droplet_info["ip"] = ip
             
-            # Save to JSON
-            save_droplet_info_json(droplet_info)
-            
-            # Create terraform statefile
-            save_statefile(droplet_info)
+            print(f"[✓] Droplet available at IP: {ip}")
+            print(f"[✓] Droplet ID: {droplet_id}")
             
-            # Run terraform commands
+            # Save to JSON and create the terraform statefile while terraform init runs,
+            # since init doesn't depend on either file
             print("\n[*] Running terraform ecosystem commands...")
-            run_terraform_commands()
+            with ThreadPoolExecutor(max_workers=3) as pool:
+                init = pool.submit(terraform_init, args.upgrade, args.no_init)
+                pool.submit(save_droplet_info_json, droplet_info, human=args.human)
+                pool.submit(save_statefile, droplet_info, human=args.human)
+            
+            # plan needs both init and the statefile
+            run_terraform_commands(init.result())
             
         elif args.action == 'destroy':
             # For destroy, we need the droplet ID from a previous run or statefile
-            if os.path.exists('droplet_info.json'):
-                with open('droplet_info.json', 'r') as f:
-                    droplet_info = json.load(f)
-                    droplet_id = droplet_info['id']
-                    
+            droplet_id = _read_droplet_id()
+            if droplet_id is not None:
                 # Delete using API
                 delete_droplet_api(token, droplet_id)
                     
@@ -276,8 +494,8 @@ def main():
                 
         elif args.action == 'plan':
             print("[*] Plan mode - showing what would be created:")
-            print(f"[+] Would create droplet with config: {listener.droplet_config}")
-            run_terraform_commands()
+            print(f"[+] Would create droplet with config: {terraform.droplet_config}")
+            run_terraform_commands(terraform_init(args.upgrade, args.no_init))
 
     except Exception as e:
         print(f"[!] Error: {e}")